@@ -1,9 +1,22 @@
+import codecs
+import os
 import re
-from typing import Generator, List
+from typing import BinaryIO, Generator, List
 from dataclasses import dataclass, field
-from functools import reduce
+from functools import cached_property, reduce
 from tempfile import NamedTemporaryFile
 from PyQt5.QtCore import pyqtSignal
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+_LIST_MARKER_RE = re.compile(r"^\w+[).] ")
+_RE2_UNSAFE_CLASSES_RE = re.compile(r"\\[wWdDsSbB]|\[:")
+_PEEK_SAMPLE_SIZE = 8 << 20
+_IO_BUFFER_SIZE = 1 << 20
+_WRITE_BATCH_SIZE = 1024
 
 
 def validate_file_options(regex: str, delimiter: str, qualifier: str) -> tuple:
@@ -19,6 +32,16 @@ def validate_file_options(regex: str, delimiter: str, qualifier: str) -> tuple:
     return not bool(error_messages), "\n".join(error_messages)
 
 
+def compile_record_start_regex(regex: str):
+    """ Compiles with RE2 when installed unless the pattern uses classes RE2 matches differently """
+    if re2 is not None and not _RE2_UNSAFE_CLASSES_RE.search(regex):
+        try:
+            return re2.compile(regex)
+        except re2.error:
+            pass
+    return re.compile(regex)
+
+
 def trim_indent(line: str) -> str:
     """ Removes indentation from multiline string """
     return re.sub(r"^ +", "", line, 0, re.MULTILINE).strip()
@@ -38,7 +61,7 @@ class BadEscape:
 
     @property
     def fix_record(self) -> str:
-        return reduce(self.escape_qualifiers, self.values, self.record)
+        return reduce(self.escape_qualifiers, dict.fromkeys(self.values), self.record)
 
 
 @dataclass
@@ -65,10 +88,11 @@ class AnalyzeResult:
 
 @dataclass
 class BadDelimiterChange:
+    __slots__ = ("row", "start", "end", "old_values")
     row: int
     start: int
     end: int
-    old_row: List[str]
+    old_values: List[str]
 
 
 class TextDataDoctor:
@@ -79,7 +103,7 @@ class TextDataDoctor:
                  delimiter: str,
                  qualifier: str,
                  encoding: str):
-        self.record_start_regex = re.compile(record_start_regex)
+        self.record_start_regex = compile_record_start_regex(record_start_regex)
         self.path = path
         self.delimiter = delimiter
         self.qualifier = qualifier
@@ -87,26 +111,50 @@ class TextDataDoctor:
         self.overflow_lines = []
         self.all_qualified = True  # Should be False
         self.header_line = ""
-        with open(path, encoding=encoding) as f:
+        with open(path, encoding=encoding, buffering=_IO_BUFFER_SIZE, newline="") as f:
             self.header_line = f.readline().rstrip("\r\n")
         self.columns = [
             column.replace(self.qualifier, "")
             for column in self.header_line.split(self.delimiter)
         ]
         self.header_delimiter_count = self.header_line.count(self.delimiter)
+        self.all_qualified_pattern = f"{self.qualifier}{self.delimiter}{self.qualifier}"
+        self.start_pattern = f"{self.delimiter}{self.qualifier}"
+        self.end_pattern = f"{self.qualifier}{self.delimiter}"
+        self._trailing_delim_re = re.compile(f"{re.escape(self.delimiter)}$")
+        if self.qualifier:
+            escaped_qualifier = re.escape(self.qualifier)
+            self._non_escaped_re = re.compile(
+                f"(?<=[^{escaped_qualifier}]){escaped_qualifier}+(?=[^{escaped_qualifier}])"
+            )
+
+    @staticmethod
+    def decodes_as(file: BinaryIO, sample: bytes, encoding: str) -> bool:
+        """ Checks the sample and the rest of the file decode using large blocks """
+        file.seek(len(sample))
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            decoder.decode(sample)
+            for block in iter(lambda: file.read(_IO_BUFFER_SIZE), b""):
+                decoder.decode(block)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return False
+        return True
 
     @staticmethod
     def peek_file(path: str, progress_signal: pyqtSignal) -> PeekResult:
         qualifier = ""
         encoding = "utf8"
-        lines: List[str] = []
 
         try:
             with open(path, "rb") as f:
-                progress_signal.emit("Collecting byte header")
-                byte_header = f.readline()
+                # The header and delimiter only need a sample but the encoding check covers the
+                # whole file since an invalid byte can appear anywhere
+                progress_signal.emit("Reading file sample")
+                sample = f.read(_PEEK_SAMPLE_SIZE)
                 progress_signal.emit("Checking for non 8 byte encoding")
-                if 0 in byte_header:
+                if 0 in sample.partition(b"\n")[0]:
                     return PeekResult(
                         -6,
                         path,
@@ -115,35 +163,28 @@ class TextDataDoctor:
                         This usually means the file is not an 8 byte encoding.
                         Currently this application only supports 8 byte encodings""")
                     )
-                header = byte_header.decode(encoding).rstrip("\r\n")
-                progress_signal.emit("Reading lines to confirm utf8 encoding")
-                for byte_line in f:
-                    lines.append(byte_line.decode(encoding))
+                progress_signal.emit("Decoding file to confirm utf8 encoding")
+                bad_lines = []
+                if not TextDataDoctor.decodes_as(f, sample, encoding):
+                    encoding = "cp1252"
+                    progress_signal.emit("utf8 failed. Trying cp1252")
+                    if not TextDataDoctor.decodes_as(f, sample, encoding):
+                        f.seek(0)
+                        lines = (byte_line.decode(encoding, errors="replace") for byte_line in f)
+                        bad_lines = [line for line in lines if "\ufffd" in line]
         except FileNotFoundError:
             return PeekResult(-1, path, "File not found")
-        except UnicodeDecodeError:
-            bad_lines = []
-            encoding = "cp1252"
-            progress_signal.emit("utf8 failed. Trying cp1252")
-            with open(path, "rb") as f:
-                header = f.readline().decode(encoding).rstrip("\r\n")
-                lines = []
-                for byte_line in f:
-                    try:
-                        line = byte_line.decode(encoding)
-                        lines.append(line)
-                    except UnicodeDecodeError:
-                        bad_lines.append(byte_line)
-
-            if bad_lines:
-                PeekResult(
-                    -2,
-                    path,
-                    trim_indent("""
-                    Encoding is not ut8 and cp1252 failed as well.
-                    This means the file contains an invalid byte that needs to be resolved:""")
-                    + "".join([str(line) for line in bad_lines])
-                )
+        if bad_lines:
+            return PeekResult(
+                -2,
+                path,
+                trim_indent("""
+                Encoding is not ut8 and cp1252 failed as well.
+                This means the file contains an invalid byte that needs to be resolved:""")
+                + "\n"
+                + "".join(bad_lines)
+            )
+        header = sample.partition(b"\n")[0].decode(encoding, errors="replace").rstrip("\r\n")
         progress_signal.emit("Finding delimiter and qualifier")
         spacers = [
             spacer.replace(" ", "")
@@ -165,34 +206,20 @@ class TextDataDoctor:
             qualifier = check_space
         return PeekResult(1, path, "", delimiter, qualifier, encoding)
 
-    @property
-    def all_qualified_pattern(self) -> str:
-        return f"{self.qualifier}{self.delimiter}{self.qualifier}"
-
-    @property
-    def start_pattern(self) -> str:
-        return f"{self.delimiter}{self.qualifier}"
-
-    @property
-    def end_pattern(self) -> str:
-        return f"{self.qualifier}{self.delimiter}"
-
-    @property
+    @cached_property
     def filename(self) -> str:
-        return re.search(r"(?<=/)[^./]+\..+$", self.path).group(0)
-
-    def is_not_end_qualified_values(self, record: str, start: int, end: int) -> bool:
-        return self.start_pattern in record[start: end] \
-               and self.end_pattern in record[start: end] \
-               and start < end
+        return os.path.basename(self.path)
 
     def find_value_end(self, record: str, end_position: int) -> int:
         result = end_position
-        next_start = record.find(self.start_pattern, end_position + 1)
-        next_end = record.find(self.end_pattern, end_position + 1)
-        if next_end != -1:
-            if (next_start != -1 and next_end < next_start) or next_start == -1:
-                result = self.find_value_end(record, next_end)
+        while True:
+            next_start = record.find(self.start_pattern, result + 1)
+            next_end = record.find(self.end_pattern, result + 1)
+            if next_end == -1:
+                break
+            if next_start != -1 and next_end >= next_start:
+                break
+            result = next_end
         return result
 
     def get_qualifier_values(self, record: str) -> Generator[str, None, None]:
@@ -202,43 +229,57 @@ class TextDataDoctor:
             raise AttributeError("Tried to get qualified values for a blank record")
         start = 0
         end = len(record)
-        if record[0] == self.qualifier and self.end_pattern in record:
-            temp_start = record[1:].index(self.end_pattern)
-            yield record[1: temp_start]
-            start = temp_start
-        if record[-1] == self.qualifier and self.start_pattern in record:
-            last_pattern = record[:-1].rindex(self.start_pattern)
-            yield record[last_pattern + 1: end - 1]
-            end = last_pattern + 1
-        loop_counter = 0
-        while self.is_not_end_qualified_values(record, start, end):
-            try:
-                value_start = record.index(self.start_pattern, start)
-                end_position = record.index(self.end_pattern, value_start)
-                value_end = self.find_value_end(record, end_position)
-                yield record[value_start + 2: value_end]
-                start = value_end + 1
-            except IndexError as ex:
-                print(ex)
-            loop_counter += 1
-            if loop_counter > 100:
-                raise Exception("Too many while loops")
+        if record.startswith(self.qualifier):
+            first_end = record.find(self.end_pattern, 1)
+            if first_end != -1:
+                temp_start = first_end - 1
+                yield record[1: temp_start]
+                start = temp_start
+        if record.endswith(self.qualifier):
+            last_pattern = record.rfind(self.start_pattern, 0, end - 1)
+            if last_pattern != -1:
+                yield record[last_pattern + 1: end - 1]
+                end = last_pattern + 1
+        # Each pass resumes after the last value end so start always moves forward and the
+        # loop ends once no start and end pattern pair remains between start and end
+        while start < end:
+            value_start = record.find(self.start_pattern, start, end)
+            if value_start == -1 or record.find(self.end_pattern, start, end) == -1:
+                break
+            end_position = record.find(self.end_pattern, value_start)
+            if end_position == -1:
+                break
+            value_end = self.find_value_end(record, end_position)
+            yield record[value_start + 2: value_end]
+            start = value_end + 1
 
     def non_escaped_qualifiers(self, value: str) -> bool:
-        return any(
-            [
-                match.count(self.qualifier) % 2 != 0
-                for match in re.findall(
-                    f"(?<=[^{self.qualifier}]){self.qualifier}+(?=[^{self.qualifier}])",
-                    value
-                )
-            ]
-        )
+        # Matches only contain the qualifier so the match length is the qualifier count
+        for match in self._non_escaped_re.finditer(value):
+            if (match.end() - match.start()) % 2 != 0:
+                return True
+        return False
 
     def get_records(self) -> Generator[str, None, None]:
         """Generates each record from the file to analyze"""
         self.overflow_lines = []
-        with open(self.path, "r", encoding=self.encoding) as f:
+        # Attributes and bound methods used on every line are hoisted into locals so the loop
+        # below does not repeat the attribute lookups per line
+        match_record_start = self.record_start_regex.match
+        match_list_marker = _LIST_MARKER_RE.match
+        add_overflow_line = self.overflow_lines.append
+        delimiter = self.delimiter
+        qualifier = self.qualifier
+        start_pattern = self.start_pattern
+        end_pattern = self.end_pattern
+        header_delimiter_count = self.header_delimiter_count
+        with open(
+                self.path,
+                "r",
+                encoding=self.encoding,
+                buffering=_IO_BUFFER_SIZE,
+                newline=""
+        ) as f:
             f.readline()
             record = ""
             for i, line in enumerate(f):
@@ -247,7 +288,7 @@ class TextDataDoctor:
 
                 # If the line meets the regex criteria the user specified for a record, the
                 # line is appended to cleaned_lines
-                if self.record_start_regex.match(line):
+                if match_record_start(line):
                     if record:
                         yield record
                     record = line
@@ -256,31 +297,31 @@ class TextDataDoctor:
                 # If the cleaned line is blank, append that line to cleaned_lines and continue
                 if not line:
                     record += f"\r{line}"
-                    self.overflow_lines.append(i+2)
+                    add_overflow_line(i+2)
                     continue
-                elif self.qualifier:
+                elif qualifier:
                     # Find the index of the last start and last end pattern in last_record
-                    last_start = record.rfind(self.start_pattern)
-                    last_end = record.rfind(self.end_pattern)
+                    last_start = record.rfind(start_pattern)
+                    last_end = record.rfind(end_pattern)
                     check_exp = (
-                            record[-1] != self.qualifier
+                            record[-1] != qualifier
                             and last_start != -1
                             and last_start > last_end
                     )
                     if check_exp:
                         record += f"\r{line}"
-                        self.overflow_lines.append(i+2)
+                        add_overflow_line(i+2)
                         continue
                 # If the current line starts with some letter or number then a ')' or '.' then
                 # the line is probably a list for a comment field. Append to the last record
-                if re.match(r"^\w+[).] ", line):
+                if match_list_marker(line):
                     record += f"\r{line}"
-                    self.overflow_lines.append(i+2)
+                    add_overflow_line(i+2)
                 # Check if the delimiter count in the line is the same as the header line.
                 # If not, it is added as an overflow line to the last record
-                elif line.count(self.delimiter) != self.header_delimiter_count:
+                elif line.count(delimiter) != header_delimiter_count:
                     record += f"\r{line}"
-                    self.overflow_lines.append(i+2)
+                    add_overflow_line(i+2)
                 else:
                     yield record
                     record = line
@@ -293,51 +334,73 @@ class TextDataDoctor:
         too_few_delimiters = False
         temp_file = NamedTemporaryFile(
             mode="w",
+            buffering=_IO_BUFFER_SIZE,
             encoding="utf8",
             suffix=".csv",
             delete=False,
             newline="\n"
         )
+        # Written records are batched to avoid a write call per record
+        pending_records: List[str] = []
 
         temp_file.write(f"{self.header_line}\n")
         for record in self.get_records():
-            is_bad_record = False
-            if self.qualifier in record and self.qualifier:
-                if self.all_qualified:
-                    record = re.sub(f"{self.delimiter}$", "", record)
+            # Flushed at the top so records fixed by a bad escape are counted as well
+            if len(pending_records) >= _WRITE_BATCH_SIZE:
+                temp_file.write("".join(pending_records))
+                pending_records.clear()
+            # The delimiter count is a single C level scan so it is taken first. Records without
+            # a qualifier only need this count, leaving the qualifier work for records that can
+            # contain qualified values
+            delimiter_count = record.count(self.delimiter)
+            has_qualifier = bool(self.qualifier) and self.qualifier in record
+            if not has_qualifier:
+                if delimiter_count != self.header_delimiter_count:
+                    bad_delimiters.append(record)
+                    too_few_delimiters = delimiter_count < self.header_delimiter_count
+                    continue
+            else:
+                is_bad_record = False
                 if self.all_qualified:
-                    checks = record[1:-1].split(self.all_qualified_pattern)
+                    stripped_record = self._trailing_delim_re.sub("", record)
+                    delimiter_count -= len(record) - len(stripped_record)
+                    record = stripped_record
+                    qualified_values = record[1:-1].split(self.all_qualified_pattern)
                 else:
-                    checks = self.get_qualifier_values(record)
-                result = [check for check in checks if self.non_escaped_qualifiers(check)]
+                    # Qualified values are gathered once and reused by the delimiter recount
+                    qualified_values = list(self.get_qualifier_values(record))
+                result = [
+                    value
+                    for value in qualified_values
+                    if self.non_escaped_qualifiers(value)
+                ]
 
                 if result:
-                    bad_escapes.append(BadEscape(self.qualifier, record, result))
+                    # The fixed record is written in place of the original right away so it
+                    # does not need to be held until the scan finishes
+                    bad_escape = BadEscape(self.qualifier, record, result)
+                    pending_records.append(f"{bad_escape.fix_record}\n")
+                    bad_escapes.append(bad_escape)
                     is_bad_record = True
 
-            delimiter_count = record.count(self.delimiter)
-            if delimiter_count != self.header_delimiter_count:
-                if self.qualifier in record and self.qualifier:
+                if delimiter_count != self.header_delimiter_count:
                     if self.all_qualified:
+                        # The recount splits the whole record since a separator can use the
+                        # record's first or last qualifier, which the inner split does not see
                         delimiter_count = len(record.split(self.all_qualified_pattern)) - 1
                     else:
                         delimiter_count -= sum(
-                            [
-                                value.count(self.delimiter)
-                                for value in self.get_qualifier_values(record)
-                            ]
+                            value.count(self.delimiter)
+                            for value in qualified_values
                         )
                     if delimiter_count != self.header_delimiter_count:
                         bad_delimiters.append(record)
                         is_bad_record = True
                         too_few_delimiters = delimiter_count < self.header_delimiter_count
-                else:
-                    bad_delimiters.append(record)
-                    is_bad_record = True
-                    too_few_delimiters = delimiter_count < self.header_delimiter_count
-            if not is_bad_record:
-                temp_file.write(f"{record}\n")
-        temp_file.writelines([bad_escape.fix_record for bad_escape in bad_escapes])
+                if is_bad_record:
+                    continue
+            pending_records.append(f"{record}\n")
+        temp_file.write("".join(pending_records))
         if bad_escapes and bad_delimiters:
             code = -1
             message = """
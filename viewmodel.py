@@ -1,14 +1,11 @@
 import traceback
-import re
-import csv
 import os
-from PyQt5.QtCore import (QObject, pyqtSlot, QThread, pyqtSignal, QAbstractTableModel, QModelIndex,
-                          Qt, QItemSelectionModel, QPoint)
+from PyQt5.QtCore import (QObject, pyqtSlot, QThreadPool, QRunnable, pyqtSignal,
+                          QAbstractTableModel, QModelIndex, Qt, QItemSelectionModel, QPoint)
 from PyQt5.QtWidgets import QMessageBox, QFileDialog, QMenu
 from model import (validate_file_options, TextDataDoctor, PeekResult, AnalyzeResult,
                    BadDelimiterChange)
 from typing import Optional, List, Any
-from pandas import read_csv
 
 
 class MainWindowViewModel(QObject):
@@ -21,7 +18,22 @@ class MainWindowViewModel(QObject):
         self.delimiter = ""
         self.qualifier = ""
         self.encoding = ""
-        self.worker: Optional[QThread] = None
+        self.message_dialog = QMessageBox(self.view)
+        # Workers run on the shared pool and report back through signal relays that are
+        # connected once here rather than for every new worker
+        self.thread_pool = QThreadPool.globalInstance()
+        self.peek_signals = WorkerSignals()
+        self.peek_signals.start_signal.connect(self.show_progress)
+        self.peek_signals.progress_signal.connect(self.update_progress_message)
+        self.peek_signals.error_signal.connect(self.show_error_message)
+        self.peek_signals.result_signal.connect(self.handle_peek_result)
+        self.peek_signals.finished_signal.connect(self.hide_progress)
+        self.analyze_signals = WorkerSignals()
+        self.analyze_signals.start_signal.connect(self.show_progress)
+        self.analyze_signals.progress_signal.connect(self.update_progress_message)
+        self.analyze_signals.error_signal.connect(self.show_error_message)
+        self.analyze_signals.result_signal.connect(self.handle_analyze_result)
+        self.analyze_signals.finished_signal.connect(self.hide_progress)
 
     @pyqtSlot(str)
     def update_record_regex(self, text: str) -> None:
@@ -59,20 +71,19 @@ class MainWindowViewModel(QObject):
     def update_progress_message(self, text: str) -> None:
         self.view.analyzeProgress.setFormat(text)
 
+    def show_message(self, title: str, message: str) -> None:
+        self.message_dialog.setWindowTitle(title)
+        self.message_dialog.setText(message)
+        self.message_dialog.exec_()
+
     @pyqtSlot(str)
     def show_error_message(self, message: str) -> None:
-        dialog = QMessageBox()
-        dialog.setWindowTitle("Operation Error")
-        dialog.setText(message)
-        dialog.exec_()
+        self.show_message("Operation Error", message)
 
     @pyqtSlot(object)
     def handle_peek_result(self, result: PeekResult) -> None:
         if result.code < 0:
-            dialog = QMessageBox()
-            dialog.setWindowTitle("Peek Error")
-            dialog.setText(result.message)
-            dialog.exec_()
+            self.show_message("Peek Error", result.message)
             return
         self.delimiter = result.delimiter.replace("\t", "\\t")
         self.view.txt_delimiter.setText(result.delimiter.replace("\t", "\\t"))
@@ -81,7 +92,7 @@ class MainWindowViewModel(QObject):
         self.encoding = result.encoding
         self.view.cbo_encoding.setCurrentIndex(0 if result.encoding == "utf8" else 1)
         self.file_path = result.path
-        self.view.btn_choose_file.setText(re.search(r"(?<=/)[^./]+\..+$", result.path).group(0))
+        self.view.btn_choose_file.setText(os.path.basename(result.path))
 
     @pyqtSlot()
     def choose_file(self) -> None:
@@ -93,21 +104,12 @@ class MainWindowViewModel(QObject):
         )
         if not file_path:
             return
-        self.worker = PeekThread(file_path)
-        self.worker.start_signal.connect(self.show_progress)
-        self.worker.progress_signal.connect(self.update_progress_message)
-        self.worker.error_signal.connect(self.show_error_message)
-        self.worker.result_signal.connect(self.handle_peek_result)
-        self.worker.finished_signal.connect(self.hide_progress)
-        self.worker.start()
+        self.thread_pool.start(PeekRunnable(file_path, self.peek_signals))
 
     @pyqtSlot(object)
     def handle_analyze_result(self, result: AnalyzeResult):
         if result.code == -7:
-            dialog = QMessageBox()
-            dialog.setWindowTitle("Analyze Error")
-            dialog.setText(result.message)
-            dialog.exec_()
+            self.show_message("Analyze Error", result.message)
             return
         self.view.show_analyze_result(result)
 
@@ -117,10 +119,7 @@ class MainWindowViewModel(QObject):
             self.record_start_regex, self.delimiter, self.qualifier
         )
         if not is_valid:
-            dialog = QMessageBox()
-            dialog.setWindowTitle("Option Validation")
-            dialog.setText(error_message)
-            dialog.exec_()
+            self.show_message("Option Validation", error_message)
             return
         doctor = TextDataDoctor(
             self.record_start_regex,
@@ -129,16 +128,10 @@ class MainWindowViewModel(QObject):
             self.qualifier,
             self.encoding
         )
-        self.worker = AnalyzeThread(doctor)
-        self.worker.start_signal.connect(self.show_progress)
-        self.worker.progress_signal.connect(self.update_progress_message)
-        self.worker.error_signal.connect(self.show_error_message)
-        self.worker.result_signal.connect(self.handle_analyze_result)
-        self.worker.finished_signal.connect(self.hide_progress)
-        self.worker.start()
+        self.thread_pool.start(AnalyzeRunnable(doctor, self.analyze_signals))
 
 
-class PeekThread(QThread):
+class WorkerSignals(QObject):
 
     start_signal = pyqtSignal()
     progress_signal = pyqtSignal(str)
@@ -146,44 +139,51 @@ class PeekThread(QThread):
     result_signal = pyqtSignal(object)
     finished_signal = pyqtSignal()
 
-    def __init__(self, path: str):
-        super(PeekThread, self).__init__()
+    def emit_error(self, message: str) -> None:
+        """
+        Emits the message with the traceback of the exception being handled. The traceback is
+        only formatted when something is connected to the error signal
+        """
+        if self.receivers(self.error_signal) > 0:
+            self.error_signal.emit(f"{message}\n{traceback.format_exc()}")
+
+
+class PeekRunnable(QRunnable):
+
+    def __init__(self, path: str, signals: WorkerSignals):
+        super(PeekRunnable, self).__init__()
         self.path = path
+        self.signals = signals
 
     def run(self) -> None:
-        self.start_signal.emit()
+        self.signals.start_signal.emit()
         try:
-            result = TextDataDoctor.peek_file(self.path, self.progress_signal)
-        except:
-            self.error_signal.emit(f"Error during file peek\n{traceback.format_exc()}")
+            result = TextDataDoctor.peek_file(self.path, self.signals.progress_signal)
+        except Exception:
+            self.signals.emit_error("Error during file peek")
         else:
-            self.result_signal.emit(result)
+            self.signals.result_signal.emit(result)
         finally:
-            self.finished_signal.emit()
+            self.signals.finished_signal.emit()
 
 
-class AnalyzeThread(QThread):
-
-    start_signal = pyqtSignal()
-    progress_signal = pyqtSignal(str)
-    error_signal = pyqtSignal(str)
-    result_signal = pyqtSignal(object)
-    finished_signal = pyqtSignal()
+class AnalyzeRunnable(QRunnable):
 
-    def __init__(self, doctor: TextDataDoctor):
-        super(AnalyzeThread, self).__init__()
+    def __init__(self, doctor: TextDataDoctor, signals: WorkerSignals):
+        super(AnalyzeRunnable, self).__init__()
         self.doctor = doctor
+        self.signals = signals
 
     def run(self) -> None:
-        self.start_signal.emit()
+        self.signals.start_signal.emit()
         try:
             result = self.doctor.analyze_file()
-        except:
-            self.error_signal.emit(f"Error during file analyze\n{traceback.format_exc()}")
+        except Exception:
+            self.signals.emit_error("Error during file analyze")
         else:
-            self.result_signal.emit(result)
+            self.signals.result_signal.emit(result)
         finally:
-            self.finished_signal.emit()
+            self.signals.finished_signal.emit()
 
 
 class ResultWindowViewModel(QObject):
@@ -198,19 +198,21 @@ class ResultWindowViewModel(QObject):
                 bd.split(self.result.delimiter)
                 for bd in self.result.bad_delimiters
             ]
-            good_records_df = read_csv(
-                self.result.temp_file.name,
-                sep=self.result.delimiter,
-                dtype=str,
-                encoding="utf8",
-                lineterminator="\n",
-                quoting=csv.QUOTE_NONE,
-                nrows=10
-            ).fillna("")
-            good_records: List[List[str]] = [
-                list(row)
-                for row in good_records_df.itertuples(index=False)
-            ]
+            # Only a 10 record preview of the good records is needed. Lines are split directly
+            # since the temp file is unqualified and records can contain carriage returns. Values
+            # are shown exactly as stored so NA like tokens (ex. NA, NULL, None) are not blanked
+            num_columns = len(self.result.columns)
+            good_records: List[List[str]] = []
+            with open(self.result.temp_file.name, encoding="utf8", newline="\n") as f:
+                f.readline()
+                for line in f:
+                    line = line.rstrip("\n")
+                    if not line:
+                        continue
+                    values = line.split(self.result.delimiter)
+                    good_records.append(values + [""] * (num_columns - len(values)))
+                    if len(good_records) == 10:
+                        break
             self.bad_delimiter_table_model = BadDelimitersTableModel(
                 bad_delimiter_records,
                 good_records,
@@ -227,12 +229,17 @@ class ResultWindowViewModel(QObject):
         selected_cells = self.table_selection_model.selectedIndexes()
         if len(selected_cells) < 2:
             return
-        if len(set([index.row() for index in selected_cells])) > 1:
-            return
+        # Single pass over the selection that bails on the first cell outside the first row
         row = selected_cells[0].row()
-        columns = [index.column() for index in selected_cells]
-        start = min(columns)
-        end = max(columns)
+        start = end = selected_cells[0].column()
+        for index in selected_cells[1:]:
+            if index.row() != row:
+                return
+            column = index.column()
+            if column < start:
+                start = column
+            elif column > end:
+                end = column
         menu = QMenu()
         merge_action = menu.addAction("Merge")
         action = menu.exec_(self.view.bad_delimiters_table.mapToGlobal(position))
@@ -252,28 +259,42 @@ class BadDelimitersTableModel(QAbstractTableModel):
         self.current_change = -1
         self.table_changes: List[BadDelimiterChange] = []
         self.columns = columns
-        max_num_values = max([len(bd) for bd in bad_delimiters])
+        max_num_values = max(map(len, bad_delimiters), default=len(columns))
         num_extra_columns = max_num_values - len(columns)
         self.table_headers = columns + [f"extra{i + 1}" for i in range(num_extra_columns)]
         self.bad_delimiters = bad_delimiters
         self.good_records = good_records
+        # Merges only change the values within a row so the table dimensions are fixed and can
+        # be cached for the frequent row and column count calls from the view
+        self.num_columns = len(columns)
+        self.num_bad_delimiters = len(bad_delimiters)
+        self.num_rows = len(good_records) + self.num_bad_delimiters
+        self.num_table_columns = len(self.table_headers)
+        # Number of bad rows that still do not match the column count, kept current as rows
+        # are replaced so validating the fixes does not need to check every row
+        self.num_unfixed_rows = sum(1 for bd in bad_delimiters if len(bd) != self.num_columns)
 
     def rowCount(self, parent: QModelIndex = None) -> int:
-        return len(self.good_records) + len(self.bad_delimiters)
+        return self.num_rows
 
     def columnCount(self, parent: QModelIndex = None) -> int:
-        return len(self.table_headers)
+        return self.num_table_columns
 
     def data(self, index: QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        # Views request many roles per cell so other roles are rejected before touching the index
+        if role != Qt.DisplayRole:
+            return None
+        if not index.isValid():
+            return None
         row = index.row()
         column = index.column()
-        if index.isValid() and role == Qt.DisplayRole:
-            record = self.good_records[row] if row < 10 else self.bad_delimiters[row - 10]
-            if column > len(record) - 1:
-                return ""
-            else:
-                return (record[column]
-                        + ("<EOR>" if column == len(record) - 1 and row > 9 else ""))
+        record = self.good_records[row] if row < 10 else self.bad_delimiters[row - 10]
+        last_column = len(record) - 1
+        if column > last_column:
+            return ""
+        if row > 9 and column == last_column:
+            return f"{record[column]}<EOR>"
+        return record[column]
 
     def headerData(self, section: int, orientation: int, role: int = Qt.DisplayRole) -> Any:
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
@@ -284,14 +305,23 @@ class BadDelimitersTableModel(QAbstractTableModel):
     def get_row(self, row: int) -> List[str]:
         if row == -1:
             raise IndexError("Tried to get a bad delimiter row of -1")
-        if row - 10 > len(self.bad_delimiters) - 1:
+        if row - 10 > self.num_bad_delimiters - 1:
             raise IndexError("Tried to get a row that exceeds to the length of the row list")
         return self.bad_delimiters[row - 10]
 
     def get_new_row(self, row: int, start: int, end: int) -> List[str]:
         old_row = self.get_row(row)
-        new_value = self.delimiter.join(old_row[start: (end + 1)])
-        return old_row[:start] + [new_value] + old_row[(end + 1):]
+        new_row = old_row[:start]
+        new_row.append(self.delimiter.join(old_row[start: (end + 1)]))
+        new_row.extend(old_row[(end + 1):])
+        return new_row
+
+    def replace_bad_delimiter(self, bad_index: int, new_row: List[str]) -> None:
+        old_row = self.bad_delimiters[bad_index]
+        self.num_unfixed_rows += (
+            (len(new_row) != self.num_columns) - (len(old_row) != self.num_columns)
+        )
+        self.bad_delimiters[bad_index] = new_row
 
     def merge_cells(self, row: int, start: int, end: int) -> None:
         if len(self.bad_delimiters[row - 10]) > end:
@@ -304,11 +334,10 @@ class BadDelimitersTableModel(QAbstractTableModel):
                 row,
                 start,
                 end,
-                self.get_row(row)
+                self.get_row(row)[start: (end + 1)]
             )
-            self.bad_delimiters[row - 10] = new_row
-            while len(self.table_changes) - 1 > self.current_change:
-                del self.table_changes[-1]
+            self.replace_bad_delimiter(row - 10, new_row)
+            del self.table_changes[self.current_change + 1:]
             self.table_changes.append(change)
             self.current_change += 1
             self.dataChanged.emit(self.index(row, start), self.index(row, end))
@@ -318,7 +347,12 @@ class BadDelimitersTableModel(QAbstractTableModel):
         if not self.table_changes or self.current_change == -1:
             return
         change = self.table_changes[self.current_change]
-        self.bad_delimiters[change.row - 10] = change.old_row
+        # The merge replaced the values from start to end with a single value at start
+        merged_row = self.get_row(change.row)
+        old_row = merged_row[:change.start]
+        old_row.extend(change.old_values)
+        old_row.extend(merged_row[(change.start + 1):])
+        self.replace_bad_delimiter(change.row - 10, old_row)
         self.current_change -= 1
         self.dataChanged.emit(
             self.index(change.row, change.start),
@@ -331,12 +365,14 @@ class BadDelimitersTableModel(QAbstractTableModel):
             return
         self.current_change += 1
         change = self.table_changes[self.current_change]
-        self.bad_delimiters[change.row] = self.get_new_row(change.row, change.start, change.end)
+        self.replace_bad_delimiter(
+            change.row - 10,
+            self.get_new_row(change.row, change.start, change.end)
+        )
         self.dataChanged.emit(
             self.index(change.row, change.start),
             self.index(change.row, change.end)
         )
 
     def validate_fixes(self) -> bool:
-        num_columns = len(self.columns)
-        return all(len(bd) == num_columns for bd in self.bad_delimiters)
+        return self.num_unfixed_rows == 0